@@ -1,7 +1,10 @@
+import io
 import streamlit as st
 import pandas as pd
-from google import genai
-from google.genai.errors import APIError
+import numpy as np
+
+# Mô hình Gemini dùng chung cho phân tích tự động và chat
+MODEL_NAME = 'gemini-2.5-flash'
 
 # --- Cấu hình Trang Streamlit ---
 st.set_page_config(
@@ -11,31 +14,68 @@ st.set_page_config(
 
 st.title("Ứng dụng Phân Tích Báo Cáo Tài Chính 📊")
 
+# Tên 3 cột quan trọng của file Excel đầu vào
+EXCEL_COLUMNS = ['Chỉ tiêu', 'Năm trước', 'Năm sau']
+
+# Định dạng hiển thị cho bảng phân tích (Chức năng 2 & 3)
+TABLE_FORMAT = {
+    'Năm trước': '{:,.0f}',
+    'Năm sau': '{:,.0f}',
+    'Tốc độ tăng trưởng (%)': '{:.2f}%',
+    'Tỷ trọng Năm trước (%)': '{:.2f}%',
+    'Tỷ trọng Năm sau (%)': '{:.2f}%'
+}
+
+# Các chỉ tiêu chính cần tra cứu vị trí dòng
+KEY_LABELS = ('TỔNG CỘNG TÀI SẢN', 'TÀI SẢN NGẮN HẠN', 'NỢ NGẮN HẠN')
+
+# --- Hàm đọc file Excel (Cache theo nội dung file, chỉ đọc 3 cột cần thiết) ---
+@st.cache_data(show_spinner=False)
+def load_excel(data: bytes):
+    """Đọc file Excel bằng engine calamine (Rust), dự phòng bằng openpyxl nếu chưa cài đặt."""
+    read_kwargs = {'usecols': [0, 1, 2], 'names': EXCEL_COLUMNS}
+    try:
+        return pd.read_excel(io.BytesIO(data), engine='calamine', **read_kwargs)
+    except ImportError:
+        # Engine calamine cần pandas>=2.2 và python-calamine; thiếu python-calamine thì dùng openpyxl
+        # (pandas luôn mở workbook openpyxl ở chế độ read_only)
+        return pd.read_excel(io.BytesIO(data), engine='openpyxl', **read_kwargs)
+
+# --- Hàm lập chỉ mục nhãn (Chuẩn hóa 'Chỉ tiêu' một lần duy nhất) ---
+def build_row_index(df):
+    """Trả về vị trí dòng đầu tiên chứa từng chỉ tiêu chính (bỏ qua chỉ tiêu không tìm thấy)."""
+    labels_upper = df['Chỉ tiêu'].astype(str).str.upper().str.strip().to_numpy(dtype=str)
+    row_idx = {}
+    for key in KEY_LABELS:
+        matches = np.flatnonzero(np.char.find(labels_upper, key) >= 0)
+        if matches.size:
+            row_idx[key] = int(matches[0])
+    return row_idx
+
+# --- Hàm tính các cột Tăng trưởng và Tỷ trọng trên mảng float64 ---
+def compute_growth_and_ratios(prev, curr, divisor_N_1, divisor_N):
+    """Trả về (Tốc độ tăng trưởng, Tỷ trọng Năm trước, Tỷ trọng Năm sau) dưới dạng mảng NumPy."""
+    # Thay 0 bằng 1e-9 ở mẫu số bằng np.where trên buffer NumPy (thay cho .replace(0, 1e-9) trên Series)
+    growth = (curr - prev) / np.where(prev != 0, prev, 1e-9) * 100
+    return growth, (prev / divisor_N_1) * 100, (curr / divisor_N) * 100
+
 # --- Hàm tính toán chính (Sử dụng Caching để Tối ưu hiệu suất) ---
 @st.cache_data
-def process_financial_data(df):
-    """Thực hiện các phép tính Tăng trưởng và Tỷ trọng."""
+def process_financial_data(df, row_idx):
+    """Thực hiện các phép tính Tăng trưởng và Tỷ trọng (trả về DataFrame mới, không sửa df đầu vào)."""
     
     # Đảm bảo các giá trị là số để tính toán
-    numeric_cols = ['Năm trước', 'Năm sau']
-    for col in numeric_cols:
-        df[col] = pd.to_numeric(df[col], errors='coerce').fillna(0)
-    
-    # 1. Tính Tốc độ Tăng trưởng
-    # Dùng .replace(0, 1e-9) cho Series Pandas để tránh lỗi chia cho 0
-    df['Tốc độ tăng trưởng (%)'] = (
-        (df['Năm sau'] - df['Năm trước']) / df['Năm trước'].replace(0, 1e-9)
-    ) * 100
-
-    # 2. Tính Tỷ trọng theo Tổng Tài sản
-    # Lọc chỉ tiêu "TỔNG CỘNG TÀI SẢN"
-    tong_tai_san_row = df[df['Chỉ tiêu'].str.contains('TỔNG CỘNG TÀI SẢN', case=False, na=False)]
-    
-    if tong_tai_san_row.empty:
+    # Chuyển một lần sang mảng NumPy float64 để các phép chia chạy trực tiếp trên buffer
+    prev = pd.to_numeric(df['Năm trước'], errors='coerce').fillna(0).to_numpy(dtype='float64')
+    curr = pd.to_numeric(df['Năm sau'], errors='coerce').fillna(0).to_numpy(dtype='float64')
+
+    # Lấy vị trí chỉ tiêu "TỔNG CỘNG TÀI SẢN" (mẫu số của Tỷ trọng) từ chỉ mục nhãn đã lập sẵn
+    if 'TỔNG CỘNG TÀI SẢN' not in row_idx:
         raise ValueError("Không tìm thấy chỉ tiêu 'TỔNG CỘNG TÀI SẢN'.")
 
-    tong_tai_san_N_1 = tong_tai_san_row['Năm trước'].iloc[0]
-    tong_tai_san_N = tong_tai_san_row['Năm sau'].iloc[0]
+    tong_tai_san_idx = row_idx['TỔNG CỘNG TÀI SẢN']
+    tong_tai_san_N_1 = prev[tong_tai_san_idx]
+    tong_tai_san_N = curr[tong_tai_san_idx]
 
     # ******************************* PHẦN SỬA LỖI BẮT ĐẦU *******************************
     # Lỗi xảy ra khi dùng .replace() trên giá trị đơn lẻ (numpy.int64).
@@ -43,20 +83,76 @@ def process_financial_data(df):
     
     divisor_N_1 = tong_tai_san_N_1 if tong_tai_san_N_1 != 0 else 1e-9
     divisor_N = tong_tai_san_N if tong_tai_san_N != 0 else 1e-9
-
-    # Tính tỷ trọng với mẫu số đã được xử lý
-    df['Tỷ trọng Năm trước (%)'] = (df['Năm trước'] / divisor_N_1) * 100
-    df['Tỷ trọng Năm sau (%)'] = (df['Năm sau'] / divisor_N) * 100
     # ******************************* PHẦN SỬA LỖI KẾT THÚC *******************************
-    
-    return df
+
+    # 1. Tính Tốc độ Tăng trưởng & 2. Tính Tỷ trọng theo Tổng Tài sản
+    growth, ratio_N_1, ratio_N = compute_growth_and_ratios(prev, curr, divisor_N_1, divisor_N)
+
+    # Gắn tất cả các cột kết quả (đều là float64) trong một lần gọi assign
+    return df.assign(**{
+        'Năm trước': prev,
+        'Năm sau': curr,
+        'Tốc độ tăng trưởng (%)': growth,
+        'Tỷ trọng Năm trước (%)': ratio_N_1,
+        'Tỷ trọng Năm sau (%)': ratio_N,
+    })
+
+# --- Hàm chọn dữ liệu bối cảnh cho Chat (Chỉ gửi các dòng liên quan) ---
+def build_chat_context(df, row_idx, top_n=15):
+    """Tóm tắt ngắn kèm TSV của các dòng chỉ tiêu chính và top_n dòng có mức thay đổi tuyệt đối lớn nhất."""
+    prev = df['Năm trước'].to_numpy()
+    curr = df['Năm sau'].to_numpy()
+    # Xếp hạng theo |Năm sau - Năm trước| thay vì tốc độ tăng trưởng: các dòng có Năm trước = 0
+    # có tăng trưởng rất lớn do mẫu số 1e-9 và sẽ lấn át các thay đổi trọng yếu
+    top_rows = np.argsort(-np.abs(curr - prev), kind='stable')[:top_n]
+    # Giữ nguyên thứ tự dòng như trong báo cáo gốc
+    rows = np.union1d(list(row_idx.values()), top_rows).astype(int)
+
+    summary = (
+        f"Bảng gồm {len(df)} chỉ tiêu; dưới đây là {rows.size} chỉ tiêu chính "
+        "và có mức thay đổi tuyệt đối lớn nhất.\n"
+    )
+    if 'TỔNG CỘNG TÀI SẢN' in row_idx:
+        idx = row_idx['TỔNG CỘNG TÀI SẢN']
+        summary += (
+            f"Tổng cộng tài sản: Năm trước {prev[idx]:,.0f}, Năm sau {curr[idx]:,.0f}, "
+            f"tăng trưởng {df['Tốc độ tăng trưởng (%)'].iat[idx]:.2f}%.\n"
+        )
+    return f"{summary}\n{_df_tsv(df.iloc[rows])}"
+
+# --- Hàm chuyển DataFrame sang TSV cho Gemini (Cache để không dựng lại mỗi lượt chat) ---
+@st.cache_data
+def _df_tsv(df):
+    """Chuyển bảng đã phân tích sang TSV (bộ ghi CSV viết bằng C của pandas) một lần cho mỗi DataFrame."""
+    # Làm tròn 2 chữ số thập phân để không gửi các số đầy đủ độ chính xác (tốn token) cho Gemini
+    return df.to_csv(sep='\t', index=False, float_format='%.2f')
+
+# --- Hàm dựng dữ liệu gửi cho AI ở Chức năng 5 (Cache theo dữ liệu đầu vào) ---
+@st.cache_data
+def _build_ai_payload(df, tsnh_growth, thanh_toan_N_1, thanh_toan_N):
+    """Dựng văn bản gồm toàn bộ bảng phân tích (TSV) và các chỉ số chính để gửi cho Gemini."""
+    return (
+        f"Toàn bộ Bảng phân tích (dữ liệu thô, phân tách bằng tab):\n{_df_tsv(df)}\n"
+        f"Tăng trưởng Tài sản ngắn hạn (%): {tsnh_growth}\n"
+        f"Thanh toán hiện hành (N-1): {thanh_toan_N_1}\n"
+        f"Thanh toán hiện hành (N): {thanh_toan_N}"
+    )
+
+# --- Khởi tạo Client Gemini (Tái sử dụng qua các lần rerun) ---
+@st.cache_resource
+def _get_genai_client(api_key):
+    """Tạo một client Gemini duy nhất cho mỗi API key và dùng lại cho mọi lần gọi."""
+    # Import trễ SDK Gemini (gRPC/protobuf/auth) để không làm chậm lần hiển thị trang đầu tiên
+    from google import genai
+    return genai.Client(api_key=api_key)
 
 # --- Hàm gọi API Gemini (Dùng cho Phân tích tự động) ---
 def get_ai_analysis(data_for_ai, api_key):
     """Gửi dữ liệu phân tích đến Gemini API và nhận nhận xét."""
+    from google.genai.errors import APIError
+    
     try:
-        client = genai.Client(api_key=api_key)
-        model_name = 'gemini-2.5-flash' 
+        client = _get_genai_client(api_key)
 
         prompt = f"""
         Bạn là một chuyên gia phân tích tài chính chuyên nghiệp. Dựa trên các chỉ số tài chính sau, hãy đưa ra một nhận xét khách quan, ngắn gọn (khoảng 3-4 đoạn) về tình hình tài chính của doanh nghiệp. Đánh giá tập trung vào tốc độ tăng trưởng, thay đổi cơ cấu tài sản và khả năng thanh toán hiện hành.
@@ -66,7 +162,7 @@ def get_ai_analysis(data_for_ai, api_key):
         """
 
         response = client.models.generate_content(
-            model=model_name,
+            model=MODEL_NAME,
             contents=prompt
         )
         return response.text
@@ -88,70 +184,97 @@ def get_ai_analysis(data_for_ai, api_key):
 if "messages" not in st.session_state:
     st.session_state["messages"] = []
 
-# Lưu trữ DataFrame đã xử lý để dùng trong Chat
-if "df_processed_for_chat" not in st.session_state:
-    st.session_state["df_processed_for_chat"] = None
+# Lưu trữ TSV của các dòng dữ liệu liên quan để dùng trong Chat
+if "chat_context" not in st.session_state:
+    st.session_state["chat_context"] = None
 
-def get_chat_response(prompt, api_key, df_processed):
-    """Xử lý logic chat, duy trì lịch sử và gọi Gemini."""
+def get_chat_response(prompt, api_key, context_data):
+    """Xử lý logic chat, duy trì lịch sử và gọi Gemini (trả về từng đoạn văn bản theo luồng)."""
+    from google.genai.errors import APIError
+    
     try:
-        client = genai.Client(api_key=api_key)
-        model_name = 'gemini-2.5-flash' 
-        
-        # Thêm ngữ cảnh về dữ liệu tài chính vào tin nhắn đầu tiên của cuộc trò chuyện.
-        # Hoặc mỗi lần gọi API nếu cần đảm bảo mô hình luôn có ngữ cảnh.
-        context_data = df_processed.to_markdown(index=False)
-        
-        # Thêm hệ thống prompt (role-playing) và ngữ cảnh vào tin nhắn đầu tiên
-        # để Gemini biết nó đang nói về dữ liệu nào.
-        # Sử dụng API chat.send_message nếu muốn duy trì lịch sử trên model
-        # hoặc gán lại toàn bộ lịch sử trong mỗi lần gọi, như cách dưới đây.
-        
-        # Xây dựng lịch sử tin nhắn cho API, bao gồm cả System Instruction (vai trò)
-        # và dữ liệu bối cảnh.
-        system_instruction = (
-            "Bạn là một chuyên gia phân tích tài chính Python/Streamlit rất giàu kinh nghiệm."
-            "Hãy trả lời các câu hỏi của người dùng dựa trên Dữ liệu Tài chính đã cung cấp."
-            "Chỉ sử dụng dữ liệu từ bảng để trả lời. Nếu không thể tính toán hoặc không có dữ liệu,"
-            "hãy nói rằng bạn không tìm thấy thông tin cần thiết."
-        )
-        
-        # Thêm dữ liệu tài chính vào tin nhắn đầu tiên của user (hoặc system) để làm bối cảnh
-        full_prompt = (
-            f"{system_instruction}\n\n"
-            f"DỮ LIỆU TÀI CHÍNH ĐÃ PHÂN TÍCH:\n{context_data}\n\n"
-            f"CÂU HỎI CỦA NGƯỜI DÙNG: {prompt}"
-        )
-        
-        # Tải lại lịch sử chat để gửi lên model
-        messages_history = [
-            {"role": "user", "parts": [{"text": full_prompt}]}
-            if msg["role"] == "user" and i == 0 else # Gán full_prompt vào tin nhắn user đầu tiên
-            {"role": "user", "parts": [{"text": msg["content"]}]}
-            if msg["role"] == "user" else 
-            {"role": "model", "parts": [{"text": msg["content"]}]}
-            for i, msg in enumerate(st.session_state.messages)
-        ]
-        
-        # Thêm tin nhắn user hiện tại (chỉ là prompt nếu không phải là tin nhắn đầu)
-        if not st.session_state.messages:
-             messages_history = [{"role": "user", "parts": [{"text": full_prompt}]}]
-        else:
-             messages_history.append({"role": "user", "parts": [{"text": prompt}]})
+        # Phiên chat được tạo một lần và lưu trong Session State; SDK tự quản lý lịch sử hội thoại
+        # nên mỗi lượt chỉ cần gửi câu hỏi mới. Tạo lại phiên khi dữ liệu bối cảnh hoặc API key thay đổi.
+        if st.session_state.get("gemini_chat_key") != (context_data, api_key):
+            client = _get_genai_client(api_key)
+            
+            # Nạp lại lịch sử đang hiển thị để phiên mới khớp với giao diện
+            # (tin nhắn cuối là câu hỏi hiện tại, sẽ được gửi bằng send_message_stream bên dưới)
+            history = [
+                {"role": "user" if msg["role"] == "user" else "model", "parts": [{"text": msg["content"]}]}
+                for msg in st.session_state.messages[:-1]
+            ]
+            
+            # System Instruction (vai trò) kèm dữ liệu bối cảnh để Gemini biết nó đang nói về dữ liệu nào.
+            system_instruction = (
+                "Bạn là một chuyên gia phân tích tài chính Python/Streamlit rất giàu kinh nghiệm."
+                "Hãy trả lời các câu hỏi của người dùng dựa trên Dữ liệu Tài chính đã cung cấp."
+                "Chỉ sử dụng dữ liệu từ bảng để trả lời. Nếu không thể tính toán hoặc không có dữ liệu,"
+                "hãy nói rằng bạn không tìm thấy thông tin cần thiết.\n\n"
+                "DỮ LIỆU TÀI CHÍNH ĐÃ PHÂN TÍCH (các chỉ tiêu chính và các chỉ tiêu biến động mạnh nhất):\n"
+                f"{context_data}"
+            )
+            
+            st.session_state["gemini_chat"] = client.chats.create(
+                model=MODEL_NAME,
+                config={"system_instruction": system_instruction},
+                history=history
+            )
+            st.session_state["gemini_chat_key"] = (context_data, api_key)
         
-        # Gọi API (Có thể thay bằng client.chats.create() và chat.send_message() nếu muốn)
-        response = client.models.generate_content(
-            model=model_name,
-            contents=messages_history
-        )
-        return response.text
+        # Gửi câu hỏi dạng streaming để hiển thị câu trả lời ngay khi các token đầu tiên về tới
+        for chunk in st.session_state["gemini_chat"].send_message_stream(prompt):
+            if chunk.text:
+                yield chunk.text
 
     except APIError as e:
-        return f"Lỗi gọi Gemini API: Vui lòng kiểm tra Khóa API hoặc giới hạn sử dụng. Chi tiết lỗi: {e}"
+        yield f"Lỗi gọi Gemini API: Vui lòng kiểm tra Khóa API hoặc giới hạn sử dụng. Chi tiết lỗi: {e}"
     except Exception as e:
-        return f"Đã xảy ra lỗi không xác định: {e}"
+        yield f"Đã xảy ra lỗi không xác định: {e}"
         
 
+# --- Khung Chat (Chạy trong fragment: mỗi lượt chat chỉ chạy lại phần này) ---
+@st.fragment
+def _chat_fragment(context_data):
+    """Hiển thị lịch sử chat, nhận câu hỏi mới và trả lời bằng Gemini."""
+    # Hiển thị các tin nhắn cũ
+    for message in st.session_state.messages:
+        with st.chat_message(message["role"]):
+            st.markdown(message["content"])
+
+    # Khung nhập liệu mới
+    if prompt := st.chat_input("Hỏi Gemini về các chỉ số tài chính (VD: 'Tốc độ tăng trưởng của Tổng tài sản là bao nhiêu?'):"):
+
+        api_key = st.secrets.get("GEMINI_API_KEY")
+
+        if not api_key:
+            st.error("Lỗi: Không tìm thấy Khóa API. Không thể bắt đầu Chat.")
+            # Thêm tin nhắn người dùng (cho lịch sử, dù không gọi API thành công)
+            st.session_state.messages.append({"role": "user", "content": prompt})
+            with st.chat_message("user"):
+                st.markdown(prompt)
+            # Tin nhắn lỗi của model
+            st.session_state.messages.append({"role": "assistant", "content": "Lỗi API Key. Vui lòng kiểm tra cấu hình Secrets."})
+            with st.chat_message("assistant"):
+                st.markdown("Lỗi API Key. Vui lòng kiểm tra cấu hình Secrets.")
+            return # Dừng hàm
+
+        # 1. Thêm tin nhắn người dùng vào lịch sử và hiển thị
+        st.session_state.messages.append({"role": "user", "content": prompt})
+        with st.chat_message("user"):
+            st.markdown(prompt)
+
+        # 2. Gọi API và hiển thị phản hồi theo luồng (st.write_stream trả về toàn bộ văn bản)
+        with st.chat_message("assistant"):
+            full_response = st.write_stream(get_chat_response(
+                prompt, 
+                api_key, 
+                context_data # Truyền TSV đã dựng sẵn
+            ))
+
+        # 3. Thêm phản hồi của AI vào lịch sử
+        st.session_state.messages.append({"role": "assistant", "content": full_response})
+
 # --- Chức năng 1: Tải File ---
 uploaded_file = st.file_uploader(
     "1. Tải file Excel Báo cáo Tài chính (Chỉ tiêu | Năm trước | Năm sau)",
@@ -160,145 +283,103 @@ uploaded_file = st.file_uploader(
 
 if uploaded_file is not None:
     try:
-        df_raw = pd.read_excel(uploaded_file)
+        # Tiền xử lý: Chỉ đọc 3 cột quan trọng và đặt tên cột ngay khi đọc
+        # Truyền bytes của file để các lần rerun với cùng file dùng lại kết quả đã cache
+        df_raw = load_excel(uploaded_file.getvalue())
         
-        # Tiền xử lý: Đảm bảo chỉ có 3 cột quan trọng
-        df_raw.columns = ['Chỉ tiêu', 'Năm trước', 'Năm sau']
+        # Lập chỉ mục nhãn một lần, dùng lại cho mọi lần tra cứu chỉ tiêu bên dưới
+        row_idx = build_row_index(df_raw)
         
         # Xử lý dữ liệu
-        df_processed = process_financial_data(df_raw.copy())
+        # Không cần .copy(): hàm trả về DataFrame mới và không thay đổi df_raw
+        df_processed = process_financial_data(df_raw, row_idx)
+        
+        # Chat chỉ nhận các dòng liên quan để giảm kích thước prompt
+        chat_context = build_chat_context(df_processed, row_idx)
         
-        # Lưu DataFrame đã xử lý vào Session State để dùng trong Chat
-        st.session_state["df_processed_for_chat"] = df_processed
+        # File mới: xóa hội thoại cũ vì nó nói về dữ liệu khác và phiên Gemini sẽ được tạo lại
+        if st.session_state["chat_context"] != chat_context:
+            st.session_state["messages"] = []
+        st.session_state["chat_context"] = chat_context
 
-        if df_processed is not None:
-            
-            # --- Chức năng 2 & 3: Hiển thị Kết quả ---
-            st.subheader("2. Tốc độ Tăng trưởng & 3. Tỷ trọng Cơ cấu Tài sản")
-            st.dataframe(df_processed.style.format({
-                'Năm trước': '{:,.0f}',
-                'Năm sau': '{:,.0f}',
-                'Tốc độ tăng trưởng (%)': '{:.2f}%',
-                'Tỷ trọng Năm trước (%)': '{:.2f}%',
-                'Tỷ trọng Năm sau (%)': '{:.2f}%'
-            }), use_container_width=True)
-            
-            # --- Chức năng 4: Tính Chỉ số Tài chính ---
-            st.subheader("4. Các Chỉ số Tài chính Cơ bản")
+        # --- Chức năng 2 & 3: Hiển thị Kết quả ---
+        st.subheader("2. Tốc độ Tăng trưởng & 3. Tỷ trọng Cơ cấu Tài sản")
+        st.dataframe(df_processed.style.format(TABLE_FORMAT, na_rep='—'), use_container_width=True)
+        
+        # --- Chức năng 4: Tính Chỉ số Tài chính ---
+        st.subheader("4. Các Chỉ số Tài chính Cơ bản")
+        
+        # Truy cập trực tiếp buffer NumPy của các cột số theo vị trí dòng trong row_idx
+        prev_arr = df_processed['Năm trước'].to_numpy()
+        curr_arr = df_processed['Năm sau'].to_numpy()
+        growth_arr = df_processed['Tốc độ tăng trưởng (%)'].to_numpy()
+        
+        try:
+            # Lọc giá trị cho Chỉ số Thanh toán Hiện hành (Ví dụ)
             
-            try:
-                # Lọc giá trị cho Chỉ số Thanh toán Hiện hành (Ví dụ)
-                
-                # Lấy Tài sản ngắn hạn
-                tsnh_n = df_processed[df_processed['Chỉ tiêu'].str.contains('TÀI SẢN NGẮN HẠN', case=False, na=False)]['Năm sau'].iloc[0]
-                tsnh_n_1 = df_processed[df_processed['Chỉ tiêu'].str.contains('TÀI SẢN NGẮN HẠN', case=False, na=False)]['Năm trước'].iloc[0]
+            # Lấy Tài sản ngắn hạn (tra vị trí một lần, đọc cả hai năm)
+            idx_tsnh = row_idx['TÀI SẢN NGẮN HẠN']
+            tsnh_n, tsnh_n_1 = curr_arr[idx_tsnh], prev_arr[idx_tsnh]
 
-                # Lấy Nợ ngắn hạn 
-                no_ngan_han_N = df_processed[df_processed['Chỉ tiêu'].str.contains('NỢ NGẮN HẠN', case=False, na=False)]['Năm sau'].iloc[0]  
-                no_ngan_han_N_1 = df_processed[df_processed['Chỉ tiêu'].str.contains('NỢ NGẮN HẠN', case=False, na=False)]['Năm trước'].iloc[0]
+            # Lấy Nợ ngắn hạn 
+            idx_nnh = row_idx['NỢ NGẮN HẠN']
+            no_ngan_han_N, no_ngan_han_N_1 = curr_arr[idx_nnh], prev_arr[idx_nnh]
 
-                # Tính toán
-                thanh_toan_hien_hanh_N = tsnh_n / no_ngan_han_N
-                thanh_toan_hien_hanh_N_1 = tsnh_n_1 / no_ngan_han_N_1
-                
-                col1, col2 = st.columns(2)
-                with col1:
-                    st.metric(
-                        label="Chỉ số Thanh toán Hiện hành (Năm trước)",
-                        value=f"{thanh_toan_hien_hanh_N_1:.2f} lần"
-                    )
-                with col2:
-                    st.metric(
-                        label="Chỉ số Thanh toán Hiện hành (Năm sau)",
-                        value=f"{thanh_toan_hien_hanh_N:.2f} lần",
-                        delta=f"{thanh_toan_hien_hanh_N - thanh_toan_hien_hanh_N_1:.2f}"
-                    )
-                    
-            except IndexError:
-                st.warning("Thiếu chỉ tiêu 'TÀI SẢN NGẮN HẠN' hoặc 'NỢ NGẮN HẠN' để tính chỉ số.")
-                thanh_toan_hien_hanh_N = "N/A" # Dùng để tránh lỗi ở Chức năng 5
-                thanh_toan_hien_hanh_N_1 = "N/A"
+            # Tính toán
+            thanh_toan_hien_hanh_N = tsnh_n / no_ngan_han_N
+            thanh_toan_hien_hanh_N_1 = tsnh_n_1 / no_ngan_han_N_1
+            
+            col1, col2 = st.columns(2)
+            with col1:
+                st.metric(
+                    label="Chỉ số Thanh toán Hiện hành (Năm trước)",
+                    value=f"{thanh_toan_hien_hanh_N_1:.2f} lần"
+                )
+            with col2:
+                st.metric(
+                    label="Chỉ số Thanh toán Hiện hành (Năm sau)",
+                    value=f"{thanh_toan_hien_hanh_N:.2f} lần",
+                    delta=f"{thanh_toan_hien_hanh_N - thanh_toan_hien_hanh_N_1:.2f}"
+                )
                 
-            # --- Chức năng 5: Nhận xét AI (Giữ nguyên) ---
-            st.subheader("5. Nhận xét Tình hình Tài chính (AI)")
+        except KeyError:
+            st.warning("Thiếu chỉ tiêu 'TÀI SẢN NGẮN HẠN' hoặc 'NỢ NGẮN HẠN' để tính chỉ số.")
+            thanh_toan_hien_hanh_N = "N/A" # Dùng để tránh lỗi ở Chức năng 5
+            thanh_toan_hien_hanh_N_1 = "N/A"
             
-            # Chuẩn bị dữ liệu để gửi cho AI
-            data_for_ai = pd.DataFrame({
-                'Chỉ tiêu': [
-                    'Toàn bộ Bảng phân tích (dữ liệu thô)', 
-                    'Tăng trưởng Tài sản ngắn hạn (%)', 
-                    'Thanh toán hiện hành (N-1)', 
-                    'Thanh toán hiện hành (N)'
-                ],
-                'Giá trị': [
-                    df_processed.to_markdown(index=False),
-                    f"{df_processed[df_processed['Chỉ tiêu'].str.contains('TÀI SẢN NGẮN HẠN', case=False, na=False)]['Tốc độ tăng trưởng (%)'].iloc[0]:.2f}%" if 'TÀI SẢN NGẮN HẠN' in df_processed['Chỉ tiêu'].str.upper().str.strip().tolist() else 'N/A', 
+        # --- Chức năng 5: Nhận xét AI (Giữ nguyên) ---
+        st.subheader("5. Nhận xét Tình hình Tài chính (AI)")
+        
+        if st.button("Yêu cầu AI Phân tích"):
+            api_key = st.secrets.get("GEMINI_API_KEY") 
+            
+            if api_key:
+                # Chỉ chuẩn bị dữ liệu gửi cho AI khi người dùng thực sự yêu cầu
+                data_for_ai = _build_ai_payload(
+                    df_processed,
+                    f"{growth_arr[row_idx['TÀI SẢN NGẮN HẠN']]:.2f}%" if 'TÀI SẢN NGẮN HẠN' in row_idx else 'N/A', 
                     f"{thanh_toan_hien_hanh_N_1}", 
                     f"{thanh_toan_hien_hanh_N}"
-                ]
-            }).to_markdown(index=False) 
+                )
+                with st.spinner('Đang gửi dữ liệu và chờ Gemini phân tích...'):
+                    ai_result = get_ai_analysis(data_for_ai, api_key)
+                st.markdown("**Kết quả Phân tích từ Gemini AI:**")
+                st.info(ai_result)
+            else:
+                st.error("Lỗi: Không tìm thấy Khóa API. Vui lòng cấu hình Khóa 'GEMINI_API_KEY' trong Streamlit Secrets.")
 
-            if st.button("Yêu cầu AI Phân tích"):
-                api_key = st.secrets.get("GEMINI_API_KEY") 
-                
-                if api_key:
-                    with st.spinner('Đang gửi dữ liệu và chờ Gemini phân tích...'):
-                        ai_result = get_ai_analysis(data_for_ai, api_key)
-                    st.markdown("**Kết quả Phân tích từ Gemini AI:**")
-                    st.info(ai_result)
-                else:
-                    st.error("Lỗi: Không tìm thấy Khóa API. Vui lòng cấu hình Khóa 'GEMINI_API_KEY' trong Streamlit Secrets.")
-
-            # ----------------------------------------------------------------------
-            #                         KHUNG CHAT ĐÃ THÊM
-            # ----------------------------------------------------------------------
-            
-            st.divider()
-            st.subheader("6. Chat với Gemini AI về Dữ liệu (Hỏi Đáp) 💬")
-            
-            # Hiển thị các tin nhắn cũ
-            for message in st.session_state.messages:
-                with st.chat_message(message["role"]):
-                    st.markdown(message["content"])
-            
-            # Khung nhập liệu mới
-            if prompt := st.chat_input("Hỏi Gemini về các chỉ số tài chính (VD: 'Tốc độ tăng trưởng của Tổng tài sản là bao nhiêu?'):"):
-                
-                api_key = st.secrets.get("GEMINI_API_KEY")
-                
-                if not api_key:
-                    st.error("Lỗi: Không tìm thấy Khóa API. Không thể bắt đầu Chat.")
-                    # Thêm tin nhắn người dùng (cho lịch sử, dù không gọi API thành công)
-                    st.session_state.messages.append({"role": "user", "content": prompt})
-                    with st.chat_message("user"):
-                        st.markdown(prompt)
-                    # Tin nhắn lỗi của model
-                    st.session_state.messages.append({"role": "assistant", "content": "Lỗi API Key. Vui lòng kiểm tra cấu hình Secrets."})
-                    with st.chat_message("assistant"):
-                        st.markdown("Lỗi API Key. Vui lòng kiểm tra cấu hình Secrets.")
-                    return # Dừng hàm
-                
-                # 1. Thêm tin nhắn người dùng vào lịch sử và hiển thị
-                st.session_state.messages.append({"role": "user", "content": prompt})
-                with st.chat_message("user"):
-                    st.markdown(prompt)
-
-                # 2. Gọi API để lấy phản hồi
-                with st.chat_message("assistant"):
-                    with st.spinner("Gemini đang phân tích và trả lời..."):
-                        # Gọi hàm mới để xử lý chat
-                        full_response = get_chat_response(
-                            prompt, 
-                            api_key, 
-                            st.session_state["df_processed_for_chat"] # Truyền DataFrame đã xử lý
-                        )
-                    st.markdown(full_response)
-                
-                # 3. Thêm phản hồi của AI vào lịch sử
-                st.session_state.messages.append({"role": "assistant", "content": full_response})
-            
-            # ----------------------------------------------------------------------
-            
+        # ----------------------------------------------------------------------
+        #                         KHUNG CHAT ĐÃ THÊM
+        # ----------------------------------------------------------------------
+        
+        st.divider()
+        st.subheader("6. Chat với Gemini AI về Dữ liệu (Hỏi Đáp) 💬")
+        
+        # Gửi câu hỏi mới chỉ chạy lại fragment chat, không chạy lại đọc file, bảng và chỉ số
+        _chat_fragment(st.session_state["chat_context"])
+        
+        # ----------------------------------------------------------------------
+        
     except ValueError as ve:
         st.error(f"Lỗi cấu trúc dữ liệu: {ve}")
     except Exception as e: